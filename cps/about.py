@@ -28,6 +28,7 @@ from collections import OrderedDict
 
 import flask
 from flask_babel import gettext as _
+from sqlalchemy import func
 
 from . import db, calibre_db, converter, uploader, constants, dep_check
 from .render_template import render_title_template
@@ -77,9 +78,9 @@ def collect_stats():
 @about.route("/stats")
 @user_login_required
 def stats():
-    counter = calibre_db.session.query(db.Books).count()
-    authors = calibre_db.session.query(db.Authors).count()
-    categories = calibre_db.session.query(db.Tags).count()
-    series = calibre_db.session.query(db.Series).count()
+    counter = calibre_db.session.query(func.count(db.Books.id)).scalar()
+    authors = calibre_db.session.query(func.count(db.Authors.id)).scalar()
+    categories = calibre_db.session.query(func.count(db.Tags.id)).scalar()
+    series = calibre_db.session.query(func.count(db.Series.id)).scalar()
     return render_title_template('stats.html', bookcounter=counter, authorcounter=authors, versions=collect_stats(),
                                  categorycounter=categories, seriecounter=series, title=_("Statistics"), page="stat")
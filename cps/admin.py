@@ -1700,7 +1700,6 @@ def _db_simulate_change():
                                            param['config_calibre_dir'],
                                            flags=re.IGNORECASE))
     db_valid, db_change = calibre_db.check_valid_db(to_save["config_calibre_dir"],
-                                                    ub.app_DB_path,
                                                     config.config_calibre_uuid)
     db_change = bool(db_change and config.config_calibre_dir)
     return db_change, db_valid
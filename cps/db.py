@@ -627,29 +627,30 @@ class CalibreDB:
                                      backref='books'))
 
     @classmethod
-    def check_valid_db(cls, config_calibre_dir, app_db_path, config_calibre_uuid):
+    def check_valid_db(cls, config_calibre_dir, config_calibre_uuid):
         if not config_calibre_dir:
             return False, False
         dbpath = os.path.join(config_calibre_dir, "metadata.db")
         if not os.path.exists(dbpath):
             return False, False
+        check_engine = create_engine('sqlite://',
+                                     echo=False,
+                                     isolation_level="SERIALIZABLE",
+                                     connect_args={'check_same_thread': False},
+                                     poolclass=StaticPool)
         try:
-            check_engine = create_engine('sqlite://',
-                                         echo=False,
-                                         isolation_level="SERIALIZABLE",
-                                         connect_args={'check_same_thread': False},
-                                         poolclass=StaticPool)
             with check_engine.begin() as connection:
+                # only the library id is read, the app settings database is not needed for the check
                 connection.execute(text("attach database '{}' as calibre;".format(dbpath)))
-                connection.execute(text("attach database '{}' as app_settings;".format(app_db_path)))
                 local_session = scoped_session(sessionmaker())
                 local_session.configure(bind=connection)
                 database_uuid = local_session().query(Library_Id).one_or_none()
 
-            check_engine.connect()
             db_change = config_calibre_uuid != database_uuid.uuid
         except Exception:
             return False, False
+        finally:
+            check_engine.dispose()
         return True, db_change
 
     def teardown(self, exception):
@@ -694,6 +695,7 @@ class CalibreDB:
                                        poolclass=StaticPool)
             with engine.begin() as connection:
                 connection.execute(text('PRAGMA cache_size = 10000;'))
+                connection.execute(text('PRAGMA temp_store = MEMORY;'))
                 connection.execute(text("attach database '{}' as calibre;".format(dbpath)))
                 connection.execute(text("attach database '{}' as app_settings;".format(app_db_path)))
 
@@ -19,6 +19,7 @@
 
 import base64
 from datetime import datetime, timezone
+from functools import lru_cache
 import os
 import uuid
 import zipfile
@@ -39,7 +40,7 @@ from flask import (
 )
 from .cw_login import current_user
 from werkzeug.datastructures import Headers
-from sqlalchemy import func
+from sqlalchemy import func, exists
 from sqlalchemy.sql.expression import and_, or_
 from sqlalchemy.exc import StatementError
 
@@ -144,6 +145,9 @@ def HandleSyncRequest():
     if not current_user.role_download():
         log.info("Users need download permissions for syncing library to Kobo reader")
         return abort(403)
+    # the user object expires on every commit of the app database, keep id and name to avoid reloading it
+    user_id = current_user.id
+    user_name = current_user.name
     sync_token = SyncToken.SyncToken.from_headers(request.headers)
     log.info("Kobo library sync request received")
     log.debug("SyncToken: {}".format(sync_token))
@@ -152,7 +156,7 @@ def HandleSyncRequest():
         log.debug('Kobo: Received unproxied request, changed request port to external server port')
 
     # if no books synced don't respect sync_token
-    if not ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.user_id == current_user.id).count():
+    if not ub.session.query(exists().where(ub.KoboSyncedBooks.user_id == user_id)).scalar():
         sync_token.books_last_modified = datetime.min
         sync_token.books_last_created = datetime.min
         sync_token.reading_state_last_modified = datetime.min
@@ -164,10 +168,6 @@ def HandleSyncRequest():
     new_archived_last_modified = datetime.min
     sync_results = []
 
-    # We reload the book database so that the user gets a fresh view of the library
-    # in case of external changes (e.g: adding a book through Calibre).
-    calibre_db.reconnect_db(config, ub.app_DB_path)
-
     only_kobo_shelves = current_user.kobo_only_shelves_sync
 
     if only_kobo_shelves:
@@ -177,9 +177,9 @@ def HandleSyncRequest():
                                                    ub.ArchivedBook.is_archived)
         changed_entries = (changed_entries
                            .join(db.Data).outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
-                                                                          ub.ArchivedBook.user_id == current_user.id))
+                                                                          ub.ArchivedBook.user_id == user_id))
                            .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
-                                                      .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
+                                                      .filter(ub.KoboSyncedBooks.user_id == user_id)))
                            .filter(ub.BookShelf.date_added > sync_token.books_last_modified)
                            .filter(db.Data.format.in_(KOBO_FORMATS))
                            .filter(calibre_db.common_filters(allow_show_archived=True))
@@ -187,7 +187,7 @@ def HandleSyncRequest():
                            .order_by(ub.ArchivedBook.last_modified)
                            .join(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)
                            .join(ub.Shelf)
-                           .filter(ub.Shelf.user_id == current_user.id)
+                           .filter(ub.Shelf.user_id == user_id)
                            .filter(ub.Shelf.kobo_sync)
                            .distinct())
     else:
@@ -196,60 +196,61 @@ def HandleSyncRequest():
                                                    ub.ArchivedBook.is_archived)
         changed_entries = (changed_entries
                            .join(db.Data).outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
-                                                                          ub.ArchivedBook.user_id == current_user.id))
+                                                                          ub.ArchivedBook.user_id == user_id))
                            .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
-                                                      .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
+                                                      .filter(ub.KoboSyncedBooks.user_id == user_id)))
                            .filter(calibre_db.common_filters(allow_show_archived=True))
                            .filter(db.Data.format.in_(KOBO_FORMATS))
                            .order_by(db.Books.last_modified)
                            .order_by(db.Books.id))
 
     reading_states_in_new_entitlements = []
-    books = changed_entries.limit(SYNC_ITEM_LIMIT)
-    log.debug("Books to Sync: {}".format(len(books.all())))
+    synced_book_ids = []
+    books = changed_entries.limit(SYNC_ITEM_LIMIT).all()
+    log.debug("Books to Sync: {}".format(len(books)))
+    # settings are constant for the whole request, don't look them up again for every book
+    kepubify_path = config.config_kepubifypath
+    # all entitlements of one sync response share the same activation timestamp
+    active_from = convert_to_kobo_timestamp_string(datetime.now(timezone.utc))
     for book in books:
-        formats = [data.format for data in book.Books.data]
-        if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
-            helper.convert_book_format(book.Books.id, config.get_book_path(), 'EPUB', 'KEPUB', current_user.name)
+        book_entry = book.Books
+        formats = [data.format for data in book_entry.data]
+        if 'KEPUB' not in formats and kepubify_path and 'EPUB' in formats:
+            helper.convert_book_format(book_entry.id, config.get_book_path(), 'EPUB', 'KEPUB', user_name)
 
-        kobo_reading_state = get_or_create_reading_state(book.Books.id)
+        kobo_reading_state = get_or_create_reading_state(book_entry.id, user_id)
         entitlement = {
-            "BookEntitlement": create_book_entitlement(book.Books, archived=(book.is_archived==True)),
-            "BookMetadata": get_metadata(book.Books),
+            "BookEntitlement": create_book_entitlement(book_entry, archived=(book.is_archived==True),
+                                                        active_from=active_from),
+            "BookMetadata": get_metadata(book_entry),
         }
 
         if kobo_reading_state.last_modified > sync_token.reading_state_last_modified:
-            entitlement["ReadingState"] = get_kobo_reading_state_response(book.Books, kobo_reading_state)
+            entitlement["ReadingState"] = get_kobo_reading_state_response(book_entry, kobo_reading_state)
             new_reading_state_last_modified = max(new_reading_state_last_modified, kobo_reading_state.last_modified)
-            reading_states_in_new_entitlements.append(book.Books.id)
-
-        ts_created = book.Books.timestamp.replace(tzinfo=None)
+            reading_states_in_new_entitlements.append(book_entry.id)
 
-        try:
+        ts_created = book_entry.timestamp.replace(tzinfo=None)
+        ts_modified = book_entry.last_modified.replace(tzinfo=None)
+        # date_added is only part of the result rows if just the kobo shelves are synced
+        if only_kobo_shelves:
             ts_created = max(ts_created, book.date_added)
-        except AttributeError:
-            pass
+            ts_modified = max(ts_modified, book.date_added)
 
         if ts_created > sync_token.books_last_created:
             sync_results.append({"NewEntitlement": entitlement})
         else:
             sync_results.append({"ChangedEntitlement": entitlement})
 
-        new_books_last_modified = max(
-            book.Books.last_modified.replace(tzinfo=None), new_books_last_modified
-        )
-        try:
-            new_books_last_modified = max(
-                new_books_last_modified, book.date_added
-            )
-        except AttributeError:
-            pass
+        new_books_last_modified = max(ts_modified, new_books_last_modified)
 
         new_books_last_created = max(ts_created, new_books_last_created)
-        kobo_sync_status.add_synced_books(book.Books.id)
+        synced_book_ids.append(book_entry.id)
+
+    kobo_sync_status.add_synced_books(synced_book_ids, user_id)
 
     max_change = changed_entries.filter(ub.ArchivedBook.is_archived)\
-        .filter(ub.ArchivedBook.user_id == current_user.id) \
+        .filter(ub.ArchivedBook.user_id == user_id) \
         .order_by(func.datetime(ub.ArchivedBook.last_modified).desc()).first()
 
     max_change = max_change.last_modified if max_change else new_archived_last_modified
@@ -268,7 +269,7 @@ def HandleSyncRequest():
         changed_reading_states = changed_reading_states.join(ub.BookShelf,
                                                              ub.KoboReadingState.book_id == ub.BookShelf.book_id)\
             .join(ub.Shelf)\
-            .filter(current_user.id == ub.Shelf.user_id)\
+            .filter(ub.Shelf.user_id == user_id)\
             .filter(ub.Shelf.kobo_sync,
                     or_(
                         ub.KoboReadingState.last_modified > sync_token.reading_state_last_modified,
@@ -279,12 +280,21 @@ def HandleSyncRequest():
             ub.KoboReadingState.last_modified > sync_token.reading_state_last_modified)
 
     changed_reading_states = changed_reading_states.filter(
-        and_(ub.KoboReadingState.user_id == current_user.id,
+        and_(ub.KoboReadingState.user_id == user_id,
              ub.KoboReadingState.book_id.notin_(reading_states_in_new_entitlements)))\
         .order_by(ub.KoboReadingState.last_modified)
-    cont_sync |= bool(changed_reading_states.count() > SYNC_ITEM_LIMIT)
-    for kobo_reading_state in changed_reading_states.limit(SYNC_ITEM_LIMIT).all():
-        book = calibre_db.session.query(db.Books).filter(db.Books.id == kobo_reading_state.book_id).one_or_none()
+    # fetch one entry more than the limit to know whether another sync round is needed, instead of counting all
+    changed_reading_states = changed_reading_states.limit(SYNC_ITEM_LIMIT + 1).all()
+    cont_sync |= len(changed_reading_states) > SYNC_ITEM_LIMIT
+    changed_reading_states = changed_reading_states[:SYNC_ITEM_LIMIT]
+    # the reading state response only needs uuid and timestamp, fetch them for all books at once
+    state_books = {}
+    if changed_reading_states:
+        state_books = {book.id: book for book in
+                       calibre_db.session.query(db.Books.id, db.Books.uuid, db.Books.timestamp)
+                       .filter(db.Books.id.in_([state.book_id for state in changed_reading_states]))}
+    for kobo_reading_state in changed_reading_states:
+        book = state_books.get(kobo_reading_state.book_id)
         if book:
             sync_results.append({
                 "ChangedReadingState": {
@@ -293,7 +303,7 @@ def HandleSyncRequest():
             })
             new_reading_state_last_modified = max(new_reading_state_last_modified, kobo_reading_state.last_modified)
 
-    sync_shelves(sync_token, sync_results, only_kobo_shelves)
+    sync_shelves(sync_token, sync_results, user_id, only_kobo_shelves)
 
     # update last created timestamp to distinguish between new and changed entitlements
     if not cont_sync:
@@ -312,7 +322,8 @@ def generate_sync_response(sync_token, sync_results, set_cont=False):
         try:
             store_response = make_request_to_kobo_store(sync_token)
 
-            store_sync_results = store_response.json()
+            # json accepts the raw bytes directly, no need to decode the body to text first
+            store_sync_results = json.loads(store_response.content)
             sync_results += store_sync_results
             sync_token.merge_from_store_response(store_response)
             extra_headers["x-kobo-sync"] = store_response.headers.get("x-kobo-sync")
@@ -374,11 +385,11 @@ def get_download_url_for_book(book_id, book_format):
     )
 
 
-def create_book_entitlement(book, archived):
+def create_book_entitlement(book, archived, active_from):
     book_uuid = str(book.uuid)
     return {
         "Accessibility": "Full",
-        "ActivePeriod": {"From": convert_to_kobo_timestamp_string(datetime.now(timezone.utc))},
+        "ActivePeriod": {"From": active_from},
         "Created": convert_to_kobo_timestamp_string(book.timestamp),
         "CrossRevisionId": book_uuid,
         "Id": book_uuid,
@@ -425,6 +436,12 @@ def get_series(book):
     return book.series[0].name
 
 
+# Get a deterministic id based on the series name, series names repeat a lot during a sync
+@lru_cache(maxsize=1024)
+def get_series_id(series_name):
+    return str(uuid.uuid3(uuid.NAMESPACE_DNS, series_name))
+
+
 def get_seriesindex(book):
     return book.series_index if isinstance(book.series_index, float) else 1
 
@@ -440,25 +457,28 @@ def get_metadata(book):
     kepub = [data for data in book.data if data.format == 'KEPUB']
 
     for book_data in kepub if len(kepub) > 0 else book.data:
-        if book_data.format not in KOBO_FORMATS:
+        kobo_formats = KOBO_FORMATS.get(book_data.format)
+        if not kobo_formats:
+            continue
+        # layout and download url only depend on the file, not on the kobo format it is offered as
+        try:
+            fixed_layout = get_epub_layout(book, book_data) == 'pre-paginated'
+            download_url = get_download_url_for_book(book.id, book_data.format)
+        except (zipfile.BadZipfile, FileNotFoundError) as e:
+            log.error(e)
             continue
-        for kobo_format in KOBO_FORMATS[book_data.format]:
+        for kobo_format in kobo_formats:
             # log.debug('Id: %s, Format: %s' % (book.id, kobo_format))
-            try:
-                if get_epub_layout(book, book_data) == 'pre-paginated':
-                    kobo_format = 'EPUB3FL'
-                download_urls.append(
-                    {
-                        "Format": kobo_format,
-                        "Size": book_data.uncompressed_size,
-                        "Url": get_download_url_for_book(book.id, book_data.format),
-                        # The Kobo forma accepts platforms: (Generic, Android)
-                        "Platform": "Generic",
-                        # "DrmType": "None", # Not required
-                    }
-                )
-            except (zipfile.BadZipfile, FileNotFoundError) as e:
-                log.error(e)
+            download_urls.append(
+                {
+                    "Format": 'EPUB3FL' if fixed_layout else kobo_format,
+                    "Size": book_data.uncompressed_size,
+                    "Url": download_url,
+                    # The Kobo forma accepts platforms: (Generic, Android)
+                    "Platform": "Generic",
+                    # "DrmType": "None", # Not required
+                }
+            )
 
     book_uuid = book.uuid
     metadata = {
@@ -487,15 +507,15 @@ def get_metadata(book):
     }
     metadata.update(get_author(book))
 
-    if get_series(book):
-        name = get_series(book)
+    name = get_series(book)
+    if name:
         try:
+            series_index = get_seriesindex(book)
             metadata["Series"] = {
-                "Name": get_series(book),
-                "Number": get_seriesindex(book),        # ToDo Check int() ?
-                "NumberFloat": float(get_seriesindex(book)),
-                # Get a deterministic id based on the series name.
-                "Id": str(uuid.uuid3(uuid.NAMESPACE_DNS, name)),
+                "Name": name,
+                "Number": series_index,        # ToDo Check int() ?
+                "NumberFloat": float(series_index),
+                "Id": get_series_id(name),
             }
         except Exception as e:
             print(e)
@@ -569,26 +589,43 @@ def HandleTagUpdate(tag_id):
     return make_response(' ', 200)
 
 
-# Adds items to the given shelf.
-def add_items_to_shelf(items, shelf):
-    book_ids_already_in_shelf = set([book_shelf.book_id for book_shelf in shelf.books])
+# Resolves the given tag items in one pass to the ids of the books known to calibre,
+# returns these ids and the items unknown to calibre.
+def get_book_ids_for_tag_items(items):
     items_unknown_to_calibre = []
+    revision_items = []
     for item in items:
         try:
             if item["Type"] != "ProductRevisionTagItem":
                 items_unknown_to_calibre.append(item)
                 continue
-
-            book = calibre_db.get_book_by_uuid(item["RevisionId"])
-            if not book:
-                items_unknown_to_calibre.append(item)
-                continue
-
-            book_id = book.id
-            if book_id not in book_ids_already_in_shelf:
-                shelf.books.append(ub.BookShelf(book_id=book_id))
+            revision_items.append((item, item["RevisionId"]))
         except KeyError:
             items_unknown_to_calibre.append(item)
+
+    # only the book ids are needed, resolve all revision ids with one query
+    book_ids = {}
+    if revision_items:
+        book_ids = dict(calibre_db.session.query(db.Books.uuid, db.Books.id)
+                        .filter(db.Books.uuid.in_([revision_id for __, revision_id in revision_items])).all())
+    known_book_ids = []
+    for item, revision_id in revision_items:
+        book_id = book_ids.get(revision_id)
+        if book_id is None:
+            items_unknown_to_calibre.append(item)
+        else:
+            known_book_ids.append(book_id)
+    return known_book_ids, items_unknown_to_calibre
+
+
+# Adds items to the given shelf.
+def add_items_to_shelf(items, shelf):
+    book_ids_already_in_shelf = set([book_shelf.book_id for book_shelf in shelf.books])
+    book_ids, items_unknown_to_calibre = get_book_ids_for_tag_items(items)
+    for book_id in book_ids:
+        if book_id not in book_ids_already_in_shelf:
+            shelf.books.append(ub.BookShelf(book_id=book_id))
+            book_ids_already_in_shelf.add(book_id)
     return items_unknown_to_calibre
 
 
@@ -644,21 +681,9 @@ def HandleTagRemoveItem(tag_id):
     if not shelf_lib.check_shelf_edit_permissions(shelf):
         abort(401, description="User is unauthaurized to edit shelf.")
 
-    items_unknown_to_calibre = []
-    for item in items:
-        try:
-            if item["Type"] != "ProductRevisionTagItem":
-                items_unknown_to_calibre.append(item)
-                continue
-
-            book = calibre_db.get_book_by_uuid(item["RevisionId"])
-            if not book:
-                items_unknown_to_calibre.append(item)
-                continue
-
-            shelf.books.filter(ub.BookShelf.book_id == book.id).delete()
-        except KeyError:
-            items_unknown_to_calibre.append(item)
+    book_ids, items_unknown_to_calibre = get_book_ids_for_tag_items(items)
+    if book_ids:
+        shelf.books.filter(ub.BookShelf.book_id.in_(book_ids)).delete(synchronize_session=False)
     ub.session_commit()
 
     if items_unknown_to_calibre:
@@ -669,10 +694,10 @@ def HandleTagRemoveItem(tag_id):
 
 # Add new, changed, or deleted shelves to the sync_results.
 # Note: Public shelves that aren't owned by the user aren't supported.
-def sync_shelves(sync_token, sync_results, only_kobo_shelves=False):
+def sync_shelves(sync_token, sync_results, user_id, only_kobo_shelves=False):
     new_tags_last_modified = sync_token.tags_last_modified
     # transmit all archived shelfs independent of last sync (why should this matter?)
-    for shelf in ub.session.query(ub.ShelfArchive).filter(ub.ShelfArchive.user_id == current_user.id):
+    for shelf in ub.session.query(ub.ShelfArchive).filter(ub.ShelfArchive.user_id == user_id).all():
         new_tags_last_modified = max(shelf.last_modified, new_tags_last_modified)
         sync_results.append({
             "DeletedTag": {
@@ -683,13 +708,14 @@ def sync_shelves(sync_token, sync_results, only_kobo_shelves=False):
             }
         })
         ub.session.delete(shelf)
-        ub.session_commit()
+    # commit the deletions once, before the next query would autoflush them without error handling
+    ub.session_commit()
 
     extra_filters = []
     if only_kobo_shelves:
         for shelf in ub.session.query(ub.Shelf).filter(
             func.datetime(ub.Shelf.last_modified) > sync_token.tags_last_modified,
-            ub.Shelf.user_id == current_user.id,
+            ub.Shelf.user_id == user_id,
             not ub.Shelf.kobo_sync
         ):
             sync_results.append({
@@ -705,7 +731,7 @@ def sync_shelves(sync_token, sync_results, only_kobo_shelves=False):
     shelflist = ub.session.query(ub.Shelf).outerjoin(ub.BookShelf).filter(
         or_(func.datetime(ub.Shelf.last_modified) > sync_token.tags_last_modified,
             func.datetime(ub.BookShelf.date_added) > sync_token.tags_last_modified),
-        ub.Shelf.user_id == current_user.id,
+        ub.Shelf.user_id == user_id,
         *extra_filters
     ).distinct().order_by(func.datetime(ub.Shelf.last_modified).asc())
 
@@ -741,14 +767,20 @@ def create_kobo_tag(shelf):
         "Name": shelf.name,
         "Type": "UserTag"
     }
-    for book_shelf in shelf.books:
-        book = calibre_db.get_book(book_shelf.book_id)
-        if not book:
-            log.info("Book (id: %s) in BookShelf (id: %s) not found in book database",  book_shelf.book_id, shelf.id)
+    book_ids = [book_shelf.book_id for book_shelf in shelf.books]
+    # only the uuid is needed, so fetch it for the books of the shelf in chunks instead of loading every book,
+    # the chunks stay below the sql variable limit of older sqlite versions
+    book_uuids = {}
+    for i in range(0, len(book_ids), kobo_sync_status.ID_CHUNK_SIZE):
+        book_uuids.update(calibre_db.session.query(db.Books.id, db.Books.uuid)
+                          .filter(db.Books.id.in_(book_ids[i:i + kobo_sync_status.ID_CHUNK_SIZE])).all())
+    for book_id in book_ids:
+        if book_id not in book_uuids:
+            log.info("Book (id: %s) in BookShelf (id: %s) not found in book database",  book_id, shelf.id)
             continue
         tag["Items"].append(
             {
-                "RevisionId": book.uuid,
+                "RevisionId": book_uuids[book_id],
                 "Type": "ProductRevisionTagItem"
             }
         )
@@ -839,11 +871,13 @@ def get_ub_read_status(kobo_read_status):
     return string_to_enum_map[kobo_read_status]
 
 
-def get_or_create_reading_state(book_id):
+def get_or_create_reading_state(book_id, user_id=None):
+    if user_id is None:
+        user_id = int(current_user.id)
     book_read = ub.session.query(ub.ReadBook).filter(ub.ReadBook.book_id == book_id,
-                                                     ub.ReadBook.user_id == int(current_user.id)).one_or_none()
+                                                     ub.ReadBook.user_id == user_id).one_or_none()
     if not book_read:
-        book_read = ub.ReadBook(user_id=current_user.id, book_id=book_id)
+        book_read = ub.ReadBook(user_id=user_id, book_id=book_id)
     if not book_read.kobo_reading_state:
         kobo_reading_state = ub.KoboReadingState(user_id=book_read.user_id, book_id=book_id)
         kobo_reading_state.current_bookmark = ub.KoboBookmark()
@@ -23,17 +23,24 @@ from datetime import datetime, timezone
 from sqlalchemy.sql.expression import or_, and_, true
 # from sqlalchemy import exc
 
+# maximum number of ids passed to a single IN clause
+ID_CHUNK_SIZE = 500
 
-# Add the current book id to kobo_synced_books table for current user, if entry is already present,
-# do nothing (safety precaution)
-def add_synced_books(book_id):
-    is_present = ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.book_id == book_id)\
-        .filter(ub.KoboSyncedBooks.user_id == current_user.id).count()
-    if not is_present:
-        synced_book = ub.KoboSyncedBooks()
-        synced_book.user_id = current_user.id
-        synced_book.book_id = book_id
-        ub.session.add(synced_book)
+
+# Add the given book ids to kobo_synced_books table for the given user, entries already present are skipped
+# (safety precaution). All new entries are added at once and written with a single commit
+def add_synced_books(book_ids, user_id):
+    book_ids = list(dict.fromkeys(book_ids))
+    if not book_ids:
+        return
+    already_synced = ub.session.query(ub.KoboSyncedBooks.book_id)\
+        .filter(ub.KoboSyncedBooks.book_id.in_(book_ids))\
+        .filter(ub.KoboSyncedBooks.user_id == user_id).all()
+    already_synced = {entry.book_id for entry in already_synced}
+    new_entries = [ub.KoboSyncedBooks(user_id=user_id, book_id=book_id)
+                   for book_id in book_ids if book_id not in already_synced]
+    if new_entries:
+        ub.session.add_all(new_entries)
         ub.session_commit()
 
 
@@ -75,16 +82,32 @@ def update_on_sync_shelfs(user_id):
                         .join(ub.Shelf, ub.Shelf.user_id == user_id, isouter=True)
                         .filter(or_(ub.Shelf.kobo_sync == 0, ub.Shelf.kobo_sync==None))
                         .filter(ub.KoboSyncedBooks.user_id == user_id).all())
-    for b in books_to_archive:
-        change_archived_books(b.book_id, True)
-        ub.session.query(ub.KoboSyncedBooks) \
-            .filter(ub.KoboSyncedBooks.book_id == b.book_id) \
-            .filter(ub.KoboSyncedBooks.user_id == user_id).delete()
+    book_ids = list(dict.fromkeys(b.book_id for b in books_to_archive))
+    if book_ids:
+        # archive all books at once: update existing archive entries, add the missing ones
+        # the ids are sent as bound parameters, stay below the sql variable limit of older sqlite versions
+        chunks = [book_ids[i:i + ID_CHUNK_SIZE] for i in range(0, len(book_ids), ID_CHUNK_SIZE)]
+        archived_books = []
+        for chunk in chunks:
+            archived_books.extend(ub.session.query(ub.ArchivedBook).filter(ub.ArchivedBook.user_id == user_id)
+                                  .filter(ub.ArchivedBook.book_id.in_(chunk)).all())
+        for chunk in chunks:
+            ub.session.query(ub.KoboSyncedBooks) \
+                .filter(ub.KoboSyncedBooks.book_id.in_(chunk)) \
+                .filter(ub.KoboSyncedBooks.user_id == user_id).delete(synchronize_session=False)
+        # change the archive entries after the last query, so only session_commit flushes them
+        now = datetime.now(timezone.utc)
+        for archived_book in archived_books:
+            archived_book.is_archived = True
+            archived_book.last_modified = now
+        already_archived = {archived_book.book_id for archived_book in archived_books}
+        ub.session.add_all([ub.ArchivedBook(user_id=user_id, book_id=book_id, is_archived=True, last_modified=now)
+                            for book_id in book_ids if book_id not in already_archived])
         ub.session_commit()
 
     # Search all shelf which are currently not synced
-    shelves_to_archive = ub.session.query(ub.Shelf).filter(ub.Shelf.user_id == user_id).filter(
+    shelves_to_archive = ub.session.query(ub.Shelf.uuid).filter(ub.Shelf.user_id == user_id).filter(
         ub.Shelf.kobo_sync == 0).all()
-    for a in shelves_to_archive:
-        ub.session.add(ub.ShelfArchive(uuid=a.uuid, user_id=user_id))
+    if shelves_to_archive:
+        ub.session.add_all([ub.ShelfArchive(uuid=a.uuid, user_id=user_id) for a in shelves_to_archive])
         ub.session_commit()
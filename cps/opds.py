@@ -462,10 +462,10 @@ def get_metadata_calibre_companion(uuid, library):
 @requires_basic_auth_if_no_ano
 def get_database_stats():
     stat = dict()
-    stat['books'] = calibre_db.session.query(db.Books).count()
-    stat['authors'] = calibre_db.session.query(db.Authors).count()
-    stat['categories'] = calibre_db.session.query(db.Tags).count()
-    stat['series'] = calibre_db.session.query(db.Series).count()
+    stat['books'] = calibre_db.session.query(func.count(db.Books.id)).scalar()
+    stat['authors'] = calibre_db.session.query(func.count(db.Authors.id)).scalar()
+    stat['categories'] = calibre_db.session.query(func.count(db.Tags.id)).scalar()
+    stat['series'] = calibre_db.session.query(func.count(db.Series.id)).scalar()
     return make_response(jsonify(stat))
 
 
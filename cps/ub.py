@@ -491,14 +491,16 @@ class KoboStatistics(Base):
 # Updates the last_modified timestamp in the KoboReadingState table if any of its children tables are modified.
 @event.listens_for(Session, 'before_flush')
 def receive_before_flush(session, flush_context, instances):
+    # all changes of one flush share the same timestamp
+    now = datetime.now(timezone.utc)
     for change in itertools.chain(session.new, session.dirty):
         if isinstance(change, (ReadBook, KoboStatistics, KoboBookmark)):
             if change.kobo_reading_state:
-                change.kobo_reading_state.last_modified = datetime.now(timezone.utc)
+                change.kobo_reading_state.last_modified = now
     # Maintain the last_modified_bit for the Shelf table.
     for change in itertools.chain(session.new, session.deleted):
         if isinstance(change, BookShelf):
-            change.ub_shelf.last_modified = datetime.now(timezone.utc)
+            change.ub_shelf.last_modified = now
 
 
 # Baseclass representing Downloads from calibre-web in app.db
@@ -568,10 +570,12 @@ class Thumbnail(Base):
 
 # Add missing tables during migration of database
 def add_missing_tables(engine, _session):
-    if not engine.dialect.has_table(engine.connect(), "archived_book"):
-        ArchivedBook.__table__.create(bind=engine)
-    if not engine.dialect.has_table(engine.connect(), "thumbnail"):
-        Thumbnail.__table__.create(bind=engine)
+    # probe all tables over one connection instead of opening (and leaking) a new one per table
+    with engine.connect() as conn:
+        missing_tables = [table for table in (ArchivedBook.__table__, Thumbnail.__table__)
+                          if not engine.dialect.has_table(conn, table.name)]
+    for table in missing_tables:
+        table.create(bind=engine)
 
 
 # migrate all settings missing in registration table